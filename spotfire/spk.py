@@ -6,17 +6,17 @@
 
 import abc
 import argparse
-import datetime
+from concurrent import futures
 import fileinput
+import functools
 import glob
 from importlib import metadata as imp_md
-import io
 import json
-import locale
 import os
 import platform
 import re
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
@@ -24,6 +24,7 @@ import time
 import typing
 import uuid
 from xml.etree import ElementTree
+from xml.sax import saxutils
 import zipfile
 
 from packaging import requirements as pkg_req, utils as pkg_utils, version as pkg_version
@@ -32,7 +33,23 @@ from spotfire import cabfile, codesign, version as sf_version
 
 _Brand = dict[str, typing.Any]
 _InstalledPackages = dict[str, str]
-_PayloadFileMapping = tuple[str, str]
+_PayloadFileMapping = tuple[str, str, typing.Optional[str], os.stat_result]
+_RequiresCache = dict[str, typing.Optional[tuple[pkg_req.Requirement, ...]]]
+
+# Platform constants
+
+_PLATFORM_SYSTEM = platform.system()
+_IS_WINDOWS = _PLATFORM_SYSTEM == "Windows"
+if _IS_WINDOWS:
+    _SITE_PACKAGES_DIRNAME = "Lib\\site-packages"
+else:
+    _SITE_PACKAGES_DIRNAME = f"lib/python{sys.version_info.major}.{sys.version_info.minor}/site-packages"
+
+# Exceptions
+
+class SpkError(Exception):
+    """An exception that is raised to indicate that an SPK package cannot be built."""
+
 
 # Command line parsing helpers
 
@@ -75,12 +92,16 @@ def _error(msg: str) -> None:
 
 # Packaging helper functions
 
+@functools.total_ordering
 class _SpkVersion:
     """Represents a version number as presented in Spotfire SPK package files.  Version numbers have four components
     (organized from the largest scope to smallest): major, minor, service pack, and identifier."""
 
+    __slots__ = ("_versions", "_str")
+
     def __init__(self, major: int = 1, minor: int = 0, service_pack: int = 0, identifier: int = 0) -> None:
-        self._versions = [major, minor, service_pack, identifier]
+        self._versions: tuple[int, ...] = (major, minor, service_pack, identifier)
+        self._str: typing.Optional[str] = None
 
     @staticmethod
     def from_str(str_: str) -> '_SpkVersion':
@@ -111,38 +132,42 @@ class _SpkVersion:
         return version
 
     def __str__(self):
-        return '.'.join([str(x) for x in self._versions])
+        if self._str is None:
+            major, minor, service_pack, identifier = self._versions
+            self._str = f"{major}.{minor}.{service_pack}.{identifier}"
+        return self._str
 
     def __repr__(self):
-        return f"{self.__class__.__module__}.{self.__class__.__qualname__}{tuple(self._versions)!r}"
+        return f"{self.__class__.__module__}.{self.__class__.__qualname__}{self._versions!r}"
+
+    def _set_versions(self, versions: tuple[int, ...]) -> None:
+        self._versions = versions
+        self._str = None
 
     def increment_major(self) -> None:
         """Increment the major component of the version number.  Resets all smaller components to zero."""
-        self._versions[0] += 1
-        self._versions[1:] = [0, 0, 0]
+        self._set_versions((self._versions[0] + 1, 0, 0, 0))
 
     def increment_minor(self) -> None:
         """Increment the minor component of the version number.  Resets all smaller components to zero."""
-        self._versions[1] += 1
-        self._versions[2:] = [0, 0]
+        self._set_versions((self._versions[0], self._versions[1] + 1, 0, 0))
 
     def _decrement(self, pos, wrap_around: int) -> None:
-        while pos >= 0:
-            self._versions[pos] -= 1
-            if self._versions[pos] < 0:
-                self._versions[pos] = wrap_around
-                pos -= 1
-            else:
-                return
-        self._versions = [0, 0, 0, 0]
-        raise ValueError("Version object cannot decrement major version below zero.")
+        # Borrow from the smallest nonzero component at or above pos; every component below it wraps around
+        versions = self._versions
+        borrow = max((i for i in range(pos + 1) if versions[i]), default=-1)
+        if borrow < 0:
+            self._set_versions((0, 0, 0, 0))
+            raise ValueError("Version object cannot decrement major version below zero.")
+        self._set_versions(versions[:borrow] + (versions[borrow] - 1,) + (wrap_around,) * (pos - borrow) +
+                           versions[pos + 1:])
 
     def decrement_major(self) -> None:
         """Decrement the major component of the version number.  Resets all smaller components to zero.
 
         :raises ValueError: if the major component would be decremented below zero
         """
-        self._versions[1:] = [0, 0, 0]
+        self._set_versions(self._versions[:1] + (0, 0, 0))
         self._decrement(0, 0)
 
     def decrement_minor(self, wrap_around: int = 99) -> None:
@@ -150,7 +175,7 @@ class _SpkVersion:
 
         :param wrap_around: the value to set components that are decremented below zero
         """
-        self._versions[2:] = [0, 0]
+        self._set_versions(self._versions[:2] + (0, 0))
         self._decrement(1, wrap_around)
 
     def decrement_service_pack(self, wrap_around: int = 99) -> None:
@@ -158,10 +183,15 @@ class _SpkVersion:
 
         :param wrap_around: the value to set components that are decremented below zero
         """
-        self._versions[3:] = [0]
+        self._set_versions(self._versions[:3] + (0,))
         self._decrement(2, wrap_around)
 
-    def __lt__(self, other):
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, _SpkVersion):
+            return NotImplemented
+        return self._versions == other._versions
+
+    def __lt__(self, other: object) -> bool:
         if not isinstance(other, _SpkVersion):
             return NotImplemented
         return self._versions < other._versions
@@ -178,11 +208,8 @@ def _brand_file(filename: str, data: _Brand, comment: str, line_length: int = 72
     data_json = json.dumps(data, separators=(',', ':'))
 
     # Read in the file, ignoring any current brand.
-    lines = []
     with open(filename, "r", encoding="utf8") as file:
-        for line in file.readlines():
-            if not line.startswith(comment):
-                lines.append(line)
+        lines = [line for line in file if not line.startswith(comment)]
 
     # Add line break to ensure brand is on a new line (PYSRV-162)
     if not lines[-1].endswith("\n"):
@@ -190,15 +217,47 @@ def _brand_file(filename: str, data: _Brand, comment: str, line_length: int = 72
 
     # Now append the brand lines to what we just read in.
     brand_per_line = line_length - len(comment)
-    while data_json:
-        lines.append(f"{comment}{data_json[:brand_per_line]}\n")
-        data_json = data_json[brand_per_line:]
+    lines.extend(f"{comment}{data_json[start:start + brand_per_line]}\n"
+                 for start in range(0, len(data_json), brand_per_line))
 
     # Write out the new file.
     with open(filename, "w", encoding="utf8") as file:
         file.writelines(lines)
 
 
+def _remove_entry(entry: "os.DirEntry[str]") -> None:
+    """Remove a directory entry, including everything under it if it is a directory.
+
+    :param entry: the directory entry to remove
+    """
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path)
+    else:
+        os.unlink(entry.path)
+
+
+def _scan_directory(path: str) -> typing.Iterator["os.DirEntry[str]"]:
+    """Recursively scan a directory for files.  Like :func:`os.walk`, symbolic links to directories are reported
+    as neither files nor directories and are not followed.
+
+    :param path: the directory to scan
+    :return: iterator over the directory entries for all files (including symbolic links to files) found
+    """
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                else:
+                    yield entry
+    except OSError:
+        return
+    for subdir in subdirs:
+        yield from _scan_directory(subdir)
+
+
 def _read_brand(filename: str, comment: str) -> _Brand:
     """Read a brand from a file.
 
@@ -206,21 +265,19 @@ def _read_brand(filename: str, comment: str) -> _Brand:
     :param comment: the comment characters that prefix each line of the brand
     :return: the data that is encoded in the brand
     """
-    # Read in the file, pulling in only the lines with branding on them.
-    lines = []
+    # Read in the file, reassembling the data from only the lines with branding on them.
+    comment_length = len(comment)
     with open(filename, "r", encoding="utf8") as file:
-        for line in file.readlines():
-            if line.startswith(comment):
-                lines.append(line)
+        data_json = "".join(line[comment_length:].rstrip() for line in file if line.startswith(comment))
 
-    # Reassemble data and parse the JSON object from the brand.
-    data_json = "".join(map(lambda x: x[len(comment):].rstrip(), lines))
+    # Parse the JSON object from the brand.
     return json.loads(data_json) if data_json else {}
 
 
 class _PackageBuilder(metaclass=abc.ABCMeta):
     # pylint: disable=too-many-instance-attributes
-    excludes: list[str]
+    _excludes: typing.Optional[list[str]]
+    _exclude_prefixes: tuple[str, ...]
     _contents: list[_PayloadFileMapping]
     _cleanup_dirs: list[str]
     _cleanup_files: list[str]
@@ -232,33 +289,50 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         self.output = ""
         self.excludes = []
         self.last_scan_dir = ""
+        self.built_at = 0.0
+        self.compresslevel: typing.Optional[int] = None
         self._contents = []
         self._cleanup_dirs = []
         self._cleanup_files = []
-        if platform.system() == "Windows":
-            self._site_packages_dirname = "Lib\\site-packages"
-        else:
-            self._site_packages_dirname = f"lib/python{'.'.join([str(x) for x in sys.version_info[:2]])}/site-packages"
+
+    @property
+    def excludes(self) -> typing.Optional[list[str]]:
+        """The payload path prefixes (with backslash separators) of files to exclude from the package."""
+        return self._excludes
+
+    @excludes.setter
+    def excludes(self, excludes: typing.Optional[list[str]]) -> None:
+        self._excludes = excludes
+        # str.startswith checks a tuple of prefixes in a single call
+        self._exclude_prefixes = tuple(excludes) if excludes else ()
 
     def cleanup(self):
         """Clean up temporary files used to create the package."""
-        for dirname in self._cleanup_dirs:
-            shutil.rmtree(dirname)
+        # Removing a pip install tree is dominated by file system calls, which release the GIL; remove the top level
+        # entries of each temporary directory on a thread pool
+        with futures.ThreadPoolExecutor() as executor:
+            for dirname in self._cleanup_dirs:
+                with os.scandir(dirname) as entries:
+                    list(executor.map(_remove_entry, list(entries)))
+                os.rmdir(dirname)
         for filename in self._cleanup_files:
             os.unlink(filename)
 
-    def add(self, filename: str, archive_name: str) -> None:
+    def add(self, filename: str, archive_name: str, entry: typing.Optional["os.DirEntry[str]"] = None) -> None:
         """Add a file to the package.
 
         :param filename: the file name on disk to add to the package
         :param archive_name: the name within the package to add the file as
+        :param entry: the directory entry for the file, if it was found while scanning a directory
         """
         archive_backslash = archive_name.replace("/", "\\")
-        if self.excludes is not None:
-            for exclude in self.excludes:
-                if archive_backslash.startswith(exclude):
-                    return
-        self._contents.append((filename, archive_backslash))
+        if self._exclude_prefixes and archive_backslash.startswith(self._exclude_prefixes):
+            return
+        # Stat the file and resolve symbolic links now, so building the payload does not have to go back to the file
+        # system; directory entries found while scanning may already carry the stat result
+        file_stat = entry.stat(follow_symlinks=False) if entry is not None else os.lstat(filename)
+        link_target = os.readlink(filename) if stat.S_ISLNK(file_stat.st_mode) else None
+        self._contents.append((filename, archive_backslash, link_target, file_stat))
 
     @abc.abstractmethod
     def add_resource(self, name: str, location: str) -> None:
@@ -280,14 +354,15 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         _message(f"Scanning Python installation at {py_prefix} for files to include.")
 
         # Scan all files in the running Python's prefix
-        for root, _, filenames in os.walk(py_prefix):
-            for filename in filenames:
-                filename_ondisk = os.path.join(root, filename)
-                filename_relative = os.path.relpath(filename_ondisk, py_prefix)
-                filename_payload = f"{prefix}/{filename_relative}"
-                if not filename_relative.startswith(self._site_packages_dirname):
-                    # Omit any packages installed in site-packages
-                    self.add(filename_ondisk, filename_payload)
+        # Every path the scan yields starts with the prefix and a separator, so slicing that off gives the same result
+        # as os.path.relpath without normalizing and splitting each path again
+        payload_prefix = f"{prefix}/"
+        py_prefix_len = len(os.path.join(py_prefix, ""))
+        for entry in _scan_directory(py_prefix):
+            filename_relative = entry.path[py_prefix_len:]
+            if not filename_relative.startswith(_SITE_PACKAGES_DIRNAME):
+                # Omit any packages installed in site-packages
+                self.add(entry.path, payload_prefix + filename_relative, entry)
 
     def scan_spotfire_package(self, prefix: str) -> None:
         """Scan the 'spotfire' package (and it's .dist-info directory) into spotfire-packages.
@@ -317,8 +392,8 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
                                 into the prefix directory
         :param use_deny_list: whether to delete the packages included with the Interpreter from the
                                 temporary package area before bundling.
-        :return: a dict that maps the names of pip packages that were scanned into the SPK package to their
-                   installed versions
+        :return: a dict that maps the canonical names of pip packages that were scanned into the SPK package to
+                   their installed versions
         """
         # pylint: disable=too-many-positional-arguments,too-many-locals,too-many-branches
 
@@ -334,20 +409,13 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
             command.extend(["--constraint", constraint])
         pip_install = subprocess.run(command, check=False)
         if pip_install.returncode:
-            _error("Error installing required packages.  Aborting.")
-            self.cleanup()
-            sys.exit(1)
+            raise SpkError("Installing required packages failed.  Aborting.")
 
-        # List packages that were installed.
-        command = [sys.executable, "-m", "pip", "list", "--disable-pip-version-check", "--path", tempdir,
-                   "--format", "json"]
-        pip_list = subprocess.run(command, capture_output=True, check=False)
-        if pip_list.returncode:
-            _error("Error installing required packages.  Aborting.")
-            self.cleanup()
-            sys.exit(1)
-        package_versions_json = json.loads(pip_list.stdout.decode(locale.getpreferredencoding()))
-        package_versions = {x['name']: x['version'] for x in package_versions_json}
+        # List packages that were installed.  The metadata is right there in tempdir, so read it directly instead of
+        # starting another pip process to do the same.  Key the packages by canonical name, so that different
+        # spellings of the same name (such as 'PyYAML' and 'pyyaml') compare equal between builds.
+        package_versions: _InstalledPackages = {pkg_utils.canonicalize_name(dist.metadata["Name"]): dist.version
+                                                for dist in imp_md.distributions(path=[tempdir])}
 
         # Update RECORD files in tempdir to remove references to '../../'
         record_files = glob.glob(os.path.join(tempdir, "*.dist-info/RECORD"))
@@ -365,16 +433,13 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
 
         # Scan all files in tempdir
         _message("Scanning package files from temporary location.")
-        for root, _, filenames in os.walk(tempdir):
-            for filename in filenames:
-                filename_ondisk = os.path.join(root, filename)
-                filename_relative = os.path.relpath(filename_ondisk, tempdir)
-                if prefix_direct:
-                    filename_payload = f"{prefix}/{filename_relative}"
-                else:
-                    filename_payload = f"{prefix}/{self._site_packages_dirname}/{filename_relative}"
-                if not filename_relative.startswith(f"bin{os.path.sep}"):
-                    self.add(filename_ondisk, filename_payload)
+        payload_prefix = f"{prefix}/" if prefix_direct else f"{prefix}/{_SITE_PACKAGES_DIRNAME}/"
+        bin_prefix = f"bin{os.path.sep}"
+        tempdir_len = len(os.path.join(tempdir, ""))
+        for entry in _scan_directory(tempdir):
+            filename_relative = entry.path[tempdir_len:]
+            if not filename_relative.startswith(bin_prefix):
+                self.add(entry.path, payload_prefix + filename_relative, entry)
 
         # Always install the requirements and constraints files at the top level of the package; it's just that the
         # top level depends on whether we're building a server SPK (which will have a "root" directory) or an analyst
@@ -407,23 +472,26 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         """
         # Use the spotfire requirements file as a deny list.
         deny_list = self.requirements_of("spotfire")
+        deny_list_canonical = {pkg_utils.canonicalize_name(name) for name in deny_list}
 
-        # Find all distributions in the temp directory
-        dist_info_dirs = glob.glob(os.path.join(tempdir, "*.dist-info"))
-        dist_infos = [imp_md.Distribution.at(x) for x in dist_info_dirs]
-
-        # Clean any distributions on our deny list
-        for dist in dist_infos:
+        # Clean any distributions in the temp directory that are on our deny list.  The dist-info directory names
+        # start with the distribution name, so only the metadata of distributions that can match needs to be read.
+        for dist_info_dir in glob.glob(os.path.join(tempdir, "*.dist-info")):
+            dist_info_name = os.path.basename(dist_info_dir)[:-len(".dist-info")].rsplit("-", 1)[0]
+            if pkg_utils.canonicalize_name(dist_info_name) not in deny_list_canonical:
+                continue
+            dist = imp_md.Distribution.at(dist_info_dir)
             if dist.name in deny_list:
                 dist_name = dist.name
                 self._remove_package_files(tempdir, dist)
-                del package_versions[dist_name]
+                del package_versions[pkg_utils.canonicalize_name(dist_name)]
 
         _message("Completed removing files and directories for packages on the deny list.")
         return package_versions
 
     def _process_package_requirements(self, requirement, extra: typing.Optional[str] = None,
-                                      seen: typing.Optional[set[str]] = None) -> None:
+                                      seen: typing.Optional[set[str]] = None,
+                                      requires_cache: typing.Optional[_RequiresCache] = None) -> None:
         """Process the child requirements of a requirement object."""
         # Do not process if the requested extra is not part of the current requirement.
         if requirement.marker and not requirement.marker.evaluate({"extra": extra}):
@@ -434,20 +502,21 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
             seen = set()
         seen.add(requirement.name)
 
-        # Get the child requirements of the current requirement.
-        try:
-            requires = imp_md.requires(requirement.name)
-        except imp_md.PackageNotFoundError:
-            requires = None
+        # Get the child requirements of the current requirement.  They are walked once per extra, so only read and
+        # parse them once per walk.
+        if requires_cache is None:
+            requires_cache = {}
+        if requirement.name not in requires_cache:
+            requires_cache[requirement.name] = _installed_requirements(requirement.name)
+        requires = requires_cache[requirement.name]
 
         # Now recurse if any child requirements exist.
         if requires:
-            for req in requires:
-                child_req = pkg_req.Requirement(req)
+            for child_req in requires:
                 if pkg_utils.canonicalize_name(child_req.name) not in seen:
-                    self._process_package_requirements(child_req, None, seen)
+                    self._process_package_requirements(child_req, None, seen, requires_cache)
                     for child_extra in child_req.extras:
-                        self._process_package_requirements(child_req, child_extra, seen)
+                        self._process_package_requirements(child_req, child_extra, seen, requires_cache)
 
     def requirements_of(self, package: str, extra: typing.Optional[str] = None) -> set[str]:
         """Determine the requirements recursively of a package.
@@ -457,7 +526,7 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         :returns: set of package names that are recursively as requirements of the package
         """
         packages_seen: set[str] = set()
-        self._process_package_requirements(pkg_req.Requirement(package), extra, packages_seen)
+        self._process_package_requirements(pkg_req.Requirement(package), extra, packages_seen, {})
         return packages_seen
 
     def requirements_from(self, requirements: str) -> set[str]:
@@ -467,12 +536,13 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         :returns: set of package names that are recursively included by the requirements file
         """
         packages_seen: set[str] = set()
+        requires_cache: _RequiresCache = {}
         for line in requirements.splitlines():
             line = re.sub('#.*$', '', line)
             line = line.strip()
             if line:
                 req = pkg_req.Requirement(line)
-                self._process_package_requirements(req, None, packages_seen)
+                self._process_package_requirements(req, None, packages_seen, requires_cache)
         return packages_seen
 
     def _remove_package_files(self, tempdir: str, dist: imp_md.Distribution) -> None:
@@ -485,16 +555,25 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
 
         name = dist.name
         version = dist.version
+        dirs_touched = set()
         for file_loc in to_delete:
             # Delete the file
             os.remove(file_loc)
 
-            # Clean any empty directories created by the file deletion
+            # Remember the directories (up to tempdir) that the file deletion may have left empty
             file_dir = os.path.dirname(file_loc)
-            while file_dir != tempdir and not os.listdir(file_dir):
-                os.rmdir(file_dir)
+            while file_dir != tempdir and file_dir not in dirs_touched and file_dir != os.path.dirname(file_dir):
+                dirs_touched.add(file_dir)
                 file_dir = os.path.dirname(file_dir)
 
+        # Clean any empty directories, deepest first so that parents are emptied before they are tried.  Removing a
+        # directory that is not empty fails immediately, which is cheaper than listing it first.
+        for file_dir in sorted(dirs_touched, key=lambda x: x.count(os.sep), reverse=True):
+            try:
+                os.rmdir(file_dir)
+            except OSError:
+                pass
+
         _message(f"Deleted files listed in RECORD for {name}-{version}.dist-info")
 
     def scan_path_configuration_file(self, prefix: str) -> None:
@@ -503,15 +582,24 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         :param prefix: the directory within the package the Python installation is located at
         """
         _message("Adding path configuration file for spotfire-packages directory.")
-        fd, temp = tempfile.mkstemp()
-        with os.fdopen(fd, "w") as file:
-            file.write('import sys, os; '
-                       'sys.path.insert(min([i for i, x in enumerate(["site-packages" in x for x in sys.path]) if x]), '
-                       'f"{sys.prefix}{os.sep}spotfire-packages")\n')
-        if platform.system() != 'Windows':
+        fd, temp = tempfile.mkstemp(prefix="spk", suffix=".pth")
+        try:
+            # The file is a single short line; write it with one system call rather than through a text file object
+            os.write(fd, b'import sys, os; '
+                         b'sys.path.insert(min([i for i, x in enumerate(["site-packages" in x for x in sys.path]) '
+                         b'if x]), f"{sys.prefix}{os.sep}spotfire-packages")\n')
+        finally:
+            os.close(fd)
+        if not _IS_WINDOWS:
             os.chmod(temp, 0o644)
         self._cleanup_files.append(temp)
-        self.add(temp, f"{prefix}/{self._site_packages_dirname}/spotfire.pth")
+        self.add(temp, f"{prefix}/{_SITE_PACKAGES_DIRNAME}/spotfire.pth")
+
+    def _sort_contents(self) -> None:
+        """Remove duplicate payload names from the files added to the package (the last one added wins, as it would on
+        extraction) and sort the remaining files by payload name, so that similar files end up next to each other."""
+        unique = {mapping[1]: mapping for mapping in self._contents}
+        self._contents = [unique[payload] for payload in sorted(unique)]
 
     @abc.abstractmethod
     def _payload_name(self) -> str:
@@ -534,7 +622,7 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
             "SchemaVersion": "2.0",
             "Name": self.name,
             "Version": str(self.version),
-            "LastModified": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.0000000Z"),
+            "LastModified": time.strftime("%Y-%m-%dT%H:%M:%S.0000000Z", time.gmtime()),
             "SeriesId": self.id,
             "InstanceId": str(uuid.uuid4()),
             "CabinetName": self._payload_name(),
@@ -548,8 +636,9 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         return metadata
 
     @abc.abstractmethod
-    def _build_payload(self, metadata: ElementTree.Element, module: ElementTree.Element, payload_dest: str) -> None:
-        """Build the main payload archive for the SPK package."""
+    def _build_payload(self, metadata_files: typing.BinaryIO, module: ElementTree.Element, payload_dest: str) -> None:
+        """Build the main payload archive for the SPK package.  A serialized ``<File>`` element (see
+        :func:`_metadata_file_element`) is written to `metadata_files` for each file placed in the payload."""
 
     def build(self) -> None:
         """Build the SPK package."""
@@ -559,22 +648,52 @@ class _PackageBuilder(metaclass=abc.ABCMeta):
         metadata = self._create_metadata(module)
 
         # Assemble things
-        payload_fd, payload_tempfile = tempfile.mkstemp(prefix="spk")
-        os.close(payload_fd)
+        payload_tempfile: typing.Optional[str] = None
+        metadata_tempfile: typing.Optional[str] = None
         try:
             _message(f"Building Spotfire SPK package {self.output}.")
-
-            # Assemble the payload zip
-            self._build_payload(metadata, module, payload_tempfile)
+            payload_fd, payload_tempfile = tempfile.mkstemp(prefix="spk")
+            os.close(payload_fd)
+            metadata_fd, metadata_tempfile = tempfile.mkstemp(prefix="spk", suffix=".xml")
+
+            # Assemble the payload zip, streaming the <File> elements of the metadata document to disk as the files
+            # are added.  Attribute values and text are escaped, so the empty <Files> element is the only place this
+            # string can appear.
+            with open(metadata_fd, "wb") as metadata_files:
+                metadata_head, metadata_tail = _et_to_bytes(metadata).split(b"<Files />", 1)
+                metadata_files.write(metadata_head + b"<Files>")
+                self._sort_contents()
+                self._build_payload(metadata_files, module, payload_tempfile)
+                metadata_files.write(b"</Files>" + metadata_tail)
 
             # Now assemble the SPK file
-            with zipfile.ZipFile(self.output, "w", compression=zipfile.ZIP_DEFLATED) as spk:
+            with open(self.output, "wb", buffering=_ZIP_WRITE_BUFFER_SIZE) as spk_file, \
+                    zipfile.ZipFile(spk_file, "w", compression=zipfile.ZIP_DEFLATED,
+                                    compresslevel=self.compresslevel) as spk:
                 spk.writestr("module.xml", _et_to_bytes(module))
-                spk.writestr("Metadata.xml", _et_to_bytes(metadata))
-                spk.write(payload_tempfile, f"Contents/{self._payload_name()}")
+                spk.write(metadata_tempfile, "Metadata.xml")
+                # The payload is already compressed; deflating it again only costs time
+                spk.write(payload_tempfile, f"Contents/{self._payload_name()}", compress_type=zipfile.ZIP_STORED)
+            self.built_at = time.time()
             _message("Done.")
         finally:
-            os.unlink(payload_tempfile)
+            if payload_tempfile is not None:
+                os.unlink(payload_tempfile)
+            if metadata_tempfile is not None:
+                os.unlink(metadata_tempfile)
+
+
+def _installed_requirements(name: str) -> typing.Optional[tuple[pkg_req.Requirement, ...]]:
+    """Get the parsed requirements of an installed distribution.
+
+    :param name: the name of the distribution
+    :return: the requirements of the distribution, or `None` if it is not installed or has none
+    """
+    try:
+        requires = imp_md.requires(name)
+    except imp_md.PackageNotFoundError:
+        return None
+    return tuple(pkg_req.Requirement(req) for req in requires) if requires else None
 
 
 def _is_editable_distribution(dist: imp_md.PathDistribution) -> bool:
@@ -610,14 +729,69 @@ def _extract_package_requirements(package_name: str, requirements_file,
 
 
 def _et_to_bytes(element: ElementTree.Element) -> bytes:
-    # Add indentation
-    ElementTree.indent(element)
+    # Serialize the element without indentation; the documents are only ever read by Spotfire
+    return ElementTree.tostring(element, encoding="utf-8", xml_declaration=True, short_empty_elements=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _format_timestamp(timestamp: int) -> str:
+    """Format a timestamp for a ``<File>`` element of the metadata document.  Files installed together share only a
+    handful of distinct timestamps, so the formatted strings are cached.
 
-    # Serialize the element to a string
-    temp_io = io.BytesIO()
-    # noinspection PyTypeChecker
-    ElementTree.ElementTree(element).write(temp_io, encoding="utf-8", xml_declaration=True)
-    return temp_io.getvalue()
+    :param timestamp: the number of seconds since the epoch
+    :return: the formatted timestamp
+    """
+    utc = time.gmtime(timestamp)
+    return (f"{utc.tm_year:04d}-{utc.tm_mon:02d}-{utc.tm_mday:02d}"
+            f"T{utc.tm_hour:02d}:{utc.tm_min:02d}:{utc.tm_sec:02d}Z")
+
+
+def _metadata_file_element(target_relative_path: str, last_modified_date: str) -> bytes:
+    """Serialize a ``<File>`` element of the metadata document.  With thousands of files in a package, formatting
+    the element directly is much cheaper than building (and later serializing) an Element object for each.
+
+    :param target_relative_path: the name of the file within the package
+    :param last_modified_date: the timestamp of the file
+    :return: the serialized element
+    """
+    return (f'<File TargetRelativePath="{_xml_escape_attrib(target_relative_path)}" '
+            f'LastModifiedDate="{_xml_escape_attrib(last_modified_date)}" />').encode("utf-8")
+
+
+def _xml_escape_attrib(value: str) -> str:
+    # Escape the same characters as ElementTree does for attribute values
+    return saxutils.escape(value, {'"': "&quot;", "\r": "&#13;", "\n": "&#10;", "\t": "&#09;"})
+
+
+# Files up to this size are read into memory in one call when being written into a zip archive
+_ZIP_READ_LIMIT = 1 << 20
+# Zip archives are written through a buffer of this size, so that the many small chunks zlib produces are collected
+# into few large writes
+_ZIP_WRITE_BUFFER_SIZE = 1 << 20
+# Files with these extensions are already compressed, so deflating them again costs time without saving space
+_ZIP_STORED_SUFFIXES = (".7z", ".bz2", ".gif", ".gz", ".jar", ".jpeg", ".jpg", ".png", ".tgz", ".webp", ".whl",
+                        ".woff", ".woff2", ".xz", ".zip")
+
+
+def _zip_write_file(archive: zipfile.ZipFile, filename: str, arcname: str, file_stat: os.stat_result) -> None:
+    """Write a file into a zip archive, taking the archive member's metadata from an existing `stat` result instead
+    of having :mod:`zipfile` stat the file again.
+
+    :param archive: the zip archive to write the file into
+    :param filename: the filename of the file on disk
+    :param arcname: the name within the archive to write the file as
+    :param file_stat: the result of :func:`os.lstat` on `filename`
+    """
+    compress_type = zipfile.ZIP_STORED if arcname.lower().endswith(_ZIP_STORED_SUFFIXES) else archive.compression
+    if file_stat.st_size > _ZIP_READ_LIMIT:
+        # Let zipfile stream large files so that they are never held in memory all at once
+        archive.write(filename, arcname, compress_type=compress_type)
+        return
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(file_stat.st_mtime)[:6])
+    zinfo.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+    # Small files are read whole, so skip the buffered reader and let the raw file read everything in one call
+    with open(filename, "rb", buffering=0) as file:
+        archive.writestr(zinfo, file.read(), compress_type=compress_type, compresslevel=archive.compresslevel)
 
 
 class _ZipPackageBuilder(_PackageBuilder):
@@ -643,7 +817,7 @@ class _ZipPackageBuilder(_PackageBuilder):
         module_intended_client = ElementTree.SubElement(module, "intendedClient")
         module_intended_client.text = "PythonService"
         module_intended_platform = ElementTree.SubElement(module, "intendedPlatform")
-        module_intended_platform.text = platform.system().upper()
+        module_intended_platform.text = _PLATFORM_SYSTEM.upper()
         module_webplayer_folder = ElementTree.SubElement(module, "webPlayerContentFolder")
         module_webplayer_folder.text = "root"
         return module
@@ -655,40 +829,34 @@ class _ZipPackageBuilder(_PackageBuilder):
         metadata_archive.text = "zip"
         return metadata
 
-    def _build_payload(self, metadata: ElementTree.Element, module: ElementTree.Element, payload_dest: str) -> None:
+    def _build_payload(self, metadata_files: typing.BinaryIO, module: ElementTree.Element, payload_dest: str) -> None:
         """Build the main payload archive for the SPK package."""
-        metadata_files = metadata.find("Files")
-        if metadata_files is None:
-            raise RuntimeError("no <Files> element found")
         payload_script: typing.List[str] = []
-        with zipfile.ZipFile(payload_dest, "w", compression=zipfile.ZIP_DEFLATED) as payload:
+        with open(payload_dest, "wb", buffering=_ZIP_WRITE_BUFFER_SIZE) as payload_file, \
+                zipfile.ZipFile(payload_file, "w", compression=zipfile.ZIP_DEFLATED,
+                                compresslevel=self.compresslevel) as payload:
             # Add all files that are supposed to go into the package
-            for filename_ondisk, filename_payload in self._contents:
-                filename_payload_fwdslash = filename_payload.replace("\\", "/")[5:]
-                if os.path.islink(filename_ondisk):
-                    payload_script += "if [ ! -e {payload} ]; then ln -s {ondisk} {payload}; fi\n".format(
+            for filename_ondisk, filename_payload, link_target, file_stat in self._contents:
+                archive_name = filename_payload.replace("\\", "/")
+                filename_payload_fwdslash = archive_name[5:]
+                if link_target is not None:
+                    payload_script.append("if [ ! -e {payload} ]; then ln -s {ondisk} {payload}; fi\n".format(
                         payload=filename_payload_fwdslash,
-                        ondisk=os.readlink(filename_ondisk))
+                        ondisk=link_target))
                 else:
-                    payload.write(filename_ondisk, filename_payload.replace("\\", "/"))
-                    stat = os.lstat(filename_ondisk)
-                    mode = stat.st_mode & 0o7777
-                    ElementTree.SubElement(metadata_files, "File", {
-                        "TargetRelativePath": filename_payload,
-                        "LastModifiedDate": (datetime.datetime.fromtimestamp(stat.st_ctime, datetime.timezone.utc)
-                                             .strftime("%Y-%m-%dT%H:%M:%SZ")),
-                    })
-                    if platform.system() != "Windows" and mode != 0o644:
-                        payload_script += f"chmod {mode:o} {filename_payload_fwdslash}\n"
+                    _zip_write_file(payload, filename_ondisk, archive_name, file_stat)
+                    mode = file_stat.st_mode & 0o7777
+                    metadata_files.write(_metadata_file_element(filename_payload,
+                                                                _format_timestamp(int(file_stat.st_ctime))))
+                    if not _IS_WINDOWS and mode != 0o644:
+                        payload_script.append(f"chmod {mode:o} {filename_payload_fwdslash}\n")
 
             # Add the payload script if we added any lines
             if payload_script:
                 payload_script.insert(0, "#!/bin/sh\n")
                 payload.writestr(f"root/Tools/Update/{self.chmod_script_name}.sh", "".join(payload_script))
-                ElementTree.SubElement(metadata_files, "File", {
-                    "TargetRelativePath": f"root\\Tools\\Update\\{self.chmod_script_name}.sh",
-                    "LastModifiedDate": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                })
+                metadata_files.write(_metadata_file_element(f"root\\Tools\\Update\\{self.chmod_script_name}.sh",
+                                                             _format_timestamp(int(time.time()))))
 
             # Add the module.xml file
             payload.writestr("module.xml", _et_to_bytes(module))
@@ -698,9 +866,8 @@ class _CabPackageBuilder(_PackageBuilder):
     # pylint: disable=too-many-instance-attributes
 
     def __init__(self):
-        if platform.system() != "Windows":
-            _error("Cabinet based SPK packages cannot be built on non-Windows systems.  Aborting.")
-            sys.exit(1)
+        if not _IS_WINDOWS:
+            raise SpkError("Cabinet based SPK packages cannot be built on non-Windows systems.  Aborting.")
         super().__init__()
         self.cert_file = None
         self.cert_password = None
@@ -716,13 +883,14 @@ class _CabPackageBuilder(_PackageBuilder):
 
         :param args: the command line arguments processed by argparse
         """
-        self.cert_file = getattr(args, "cert")
-        self.cert_password = getattr(args, "password")
-        self.cert_store_machine = getattr(args, "store_machine")
-        self.cert_store_name = getattr(args, "store_name")
-        self.cert_store_cn = getattr(args, "store_cn")
-        self.timestamp_url = getattr(args, "timestamp")
-        self.sha256 = getattr(args, "sha256")
+        options = vars(args)
+        self.cert_file = options["cert"]
+        self.cert_password = options["password"]
+        self.cert_store_machine = options["store_machine"]
+        self.cert_store_name = options["store_name"]
+        self.cert_store_cn = options["store_cn"]
+        self.timestamp_url = options["timestamp"]
+        self.sha256 = options["sha256"]
 
     def _payload_name(self) -> str:
         """Get the payload archive name for this package."""
@@ -751,37 +919,33 @@ class _CabPackageBuilder(_PackageBuilder):
             })
         return module
 
-    def _build_payload(self, metadata: ElementTree.Element, module: ElementTree.Element, payload_dest: str) -> None:
+    def _build_payload(self, metadata_files: typing.BinaryIO, module: ElementTree.Element, payload_dest: str) -> None:
         """Build the main payload archive for the SPK package."""
-        metadata_files = metadata.find("Files")
-        if metadata_files is None:
-            raise RuntimeError("no <Files> element found")
-
         with cabfile.CabFile(payload_dest) as payload:
             # Add all files that are supposed to go into the package
-            for filename_ondisk, filename_payload in self._contents:
+            for filename_ondisk, filename_payload, _, file_stat in self._contents:
                 payload.write(filename_ondisk, filename_payload)
-                stat = os.lstat(filename_ondisk)
-                ElementTree.SubElement(metadata_files, "File", {
-                    "TargetRelativePath": filename_payload,
-                    "LastModifiedDate": (datetime.datetime.fromtimestamp(stat.st_ctime, datetime.timezone.utc)
-                                         .strftime("%Y-%m-%dT%H:%M:%SZ")),
-                })
+                metadata_files.write(_metadata_file_element(filename_payload,
+                                                            _format_timestamp(int(file_stat.st_ctime))))
 
             # Add the module.xml file
             payload.writestr("module.xml", _et_to_bytes(module))
 
         # Codesign the payload
+        self._codesign_payload(payload_dest)
+
+    def _codesign_payload(self, payload_dest: str) -> None:
+        """Codesign the payload archive, if a certificate to sign it with was given."""
         if self.cert_store_name and self.cert_store_cn:
             if self.cert_store_machine:
                 store_location = codesign.CertificateStoreLocation.LOCAL_MACHINE
             else:
                 store_location = codesign.CertificateStoreLocation.CURRENT_USER
             codesign.codesign_file_from_store(payload_dest, store_location, self.cert_store_name, self.cert_store_cn,
-                                              self.timestamp_url, self.sha256, self.sha256)
+                                              self.timestamp_url, use_rfc3161=self.sha256, use_sha256=self.sha256)
         elif self.cert_file:
-            codesign.codesign_file(payload_dest, self.cert_file, self.cert_password, self.timestamp_url, self.sha256,
-                                   self.sha256)
+            codesign.codesign_file(payload_dest, self.cert_file, self.cert_password, self.timestamp_url,
+                                   use_rfc3161=self.sha256, use_sha256=self.sha256)
 
 
 # Subcommands
@@ -793,6 +957,8 @@ class _CabPackageBuilder(_PackageBuilder):
              argument("-c", "--constraint", metavar="FILE", help="apply the constraints in the file when installing "
                                                                  "Python packages"),
              argument("--analyst", action="store_true", help="build the SPK file for use with Spotfire Analyst"),
+             argument("--fast", action="store_true", help="compress the package files faster, at the cost of a "
+                                                          "larger SPK file (Spotfire Server only)"),
              argument("--cert", metavar="FILE", help="path to the certificate file to sign the package with (Analyst "
                                                      "only)"),
              argument("--password", help="password for the certificate file (Analyst only)"),
@@ -810,28 +976,31 @@ class _CabPackageBuilder(_PackageBuilder):
              ])
 def python(args, hook=None) -> None:
     """Package the currently running Python interpreter as an SPK package"""
+    options = vars(args)
 
     # Verify the version component
-    version_identifier = getattr(args, "version")
+    version_identifier = options["version"]
     if version_identifier < 0:
-        print("Error: '--version' cannot be less than 0.")
-        sys.exit(1)
+        raise SpkError("'--version' cannot be less than 0.")
     if version_identifier < 1000:
         print("Warning: '--version' should not be less than 1000 in order to avoid conflicts with Spotfire-provided "
               "packages.")
 
     # Set up the package builder
-    analyst = getattr(args, "analyst")
+    analyst = options["analyst"]
     package_builder: _PackageBuilder
     if analyst:
         package_builder = _CabPackageBuilder()
-        package_builder.excludes = getattr(args, "exclude")
+        package_builder.excludes = options["exclude"]
         package_builder.process_signing_options(args)
+        if options.get("fast"):
+            print("Warning: '--fast' has no effect on packages built with '--analyst'.")
     else:
         package_builder = _ZipPackageBuilder()
-        package_builder.excludes = getattr(args, "exclude")
+        package_builder.excludes = options["exclude"]
         package_builder.chmod_script_name = "python_chmod"
-    package_builder.output = getattr(args, "spk-file")
+        package_builder.compresslevel = 1 if options.get("fast") else None
+    package_builder.output = options["spk-file"]
 
     # Determine the platform and any constants that depend on it
     if analyst:
@@ -841,13 +1010,12 @@ def python(args, hook=None) -> None:
         package_builder.id = {
             "Windows": "b95fbe51-c013-4f65-8523-5bffcf19e6a8",
             "Linux": "6692a2c3-d43d-4224-a8db-26619ae8f268",
-        }.get(platform.system(), "")
-        package_builder.name = f"Python Interpreter {platform.system()}"
+        }.get(_PLATFORM_SYSTEM, "")
+        package_builder.name = f"Python Interpreter {_PLATFORM_SYSTEM}"
 
     # Get the version of the Python installation
     if sys.version_info.major == 3 and sys.version_info.minor < 5:
-        print(f"Error: Unsupported version of Python ('{sys.version}').")
-        sys.exit(1)
+        raise SpkError(f"Unsupported version of Python ('{sys.version}').")
     package_builder.version = _SpkVersion.from_version_info(version_identifier)
 
     # Scan the files required to create the Python interpreter SPK
@@ -863,7 +1031,7 @@ def python(args, hook=None) -> None:
         with tempfile.NamedTemporaryFile(mode="wt", prefix="req", suffix=".txt", encoding="utf-8",
                                          delete=False) as spotfire_requirements:
             _extract_package_requirements("spotfire", spotfire_requirements)
-        constraints = getattr(args, "constraint")
+        constraints = options["constraint"]
         package_builder.scan_requirements_txt(spotfire_requirements.name, constraints, prefix)
         if hook is not None:
             hook.scan_finished(package_builder)
@@ -886,6 +1054,8 @@ def python(args, hook=None) -> None:
              argument("-c", "--constraint", metavar="FILE", help="apply the constraints in the file when installing "
                                                                  "Python packages"),
              argument("--analyst", action="store_true", help="build the SPK file for use with Spotfire Analyst"),
+             argument("--fast", action="store_true", help="compress the package files faster, at the cost of a "
+                                                          "larger SPK file (Spotfire Server only)"),
              argument("--cert", metavar="FILE", help="path to the certificate file to sign the package with (Analyst "
                                                      "only)"),
              argument("--password", help="password for the certificate file (Analyst only)"),
@@ -903,33 +1073,41 @@ def python(args, hook=None) -> None:
              ])
 def packages(args) -> None:
     """Package a list of Python packages as an SPK package"""
+    # pylint: disable=too-many-statements
+    options = vars(args)
+
+    # Set up the package builder
+    analyst = options["analyst"]
+    package_builder: _PackageBuilder
+    if analyst:
+        package_builder = _CabPackageBuilder()
+        package_builder.process_signing_options(args)
+        brand_subkey = "Analyst"
+        if options.get("fast"):
+            print("Warning: '--fast' has no effect on packages built with '--analyst'.")
+    else:
+        package_builder = _ZipPackageBuilder()
+        package_builder.chmod_script_name = "packages_chmod"
+        package_builder.compresslevel = 1 if options.get("fast") else None
+        brand_subkey = "Server"
+    package_builder.output = options["spk-file"]
+
     try:
-        # Set up the package builder
-        analyst = getattr(args, "analyst")
-        package_builder: _PackageBuilder
-        if analyst:
-            package_builder = _CabPackageBuilder()
-            package_builder.process_signing_options(args)
-            brand_subkey = "Analyst"
-        else:
-            package_builder = _ZipPackageBuilder()
-            package_builder.chmod_script_name = "packages_chmod"
-            brand_subkey = "Server"
-        package_builder.output = getattr(args, "spk-file")
-        requirements_file = getattr(args, "requirements")
+        requirements_file = options["requirements"]
         brand = _promote_brand(_read_brand(requirements_file, "## spotfire.spk: "), analyst)
-        version = getattr(args, "version")
-        force = getattr(args, "force")
-        versioned_filename = getattr(args, "versioned_filename")
-        name = getattr(args, "name") or brand[brand_subkey].get("BuiltName")
-        pkg_id = brand[brand_subkey].get("BuiltId")
+        version = options["version"]
+        force = options["force"]
+        versioned_filename = options["versioned_filename"]
+        built = brand[brand_subkey]
+        name = options["name"] or built.get("BuiltName")
+        pkg_id = built.get("BuiltId")
 
         # If name and id are not in the brand or given on the command line, generate reasonable defaults
         if name is None:
             if analyst:
                 name = "Python Packages"
             else:
-                name = f"Python Packages {platform.system()}"
+                name = f"Python Packages {_PLATFORM_SYSTEM}"
         if pkg_id is None:
             pkg_id = str(uuid.uuid4())
         package_builder.name = name
@@ -943,7 +1121,7 @@ def packages(args) -> None:
         else:
             prefix = "root/python"
             prefix_direct = False
-        constraints = getattr(args, "constraint")
+        constraints = options["constraint"]
         installed_packages = package_builder.scan_requirements_txt(requirements_file, constraints, prefix,
                                                                    prefix_direct, True)
 
@@ -954,16 +1132,17 @@ def packages(args) -> None:
         package_builder.build()
 
         # Now prepare the brand with the results of the build and apply it to our requirements file
-        brand[brand_subkey]["BuiltBy"] = sys.version
-        brand[brand_subkey]["BuiltAt"] = time.asctime(time.localtime(os.path.getmtime(package_builder.output)))
-        brand[brand_subkey]["BuiltFile"] = package_builder.output
-        brand[brand_subkey]["BuiltName"] = package_builder.name
-        brand[brand_subkey]["BuiltId"] = package_builder.id
-        brand[brand_subkey]["BuiltVersion"] = str(package_builder.version)
-        brand[brand_subkey]["BuiltPackages"] = installed_packages
+        built.update({
+            "BuiltBy": sys.version,
+            "BuiltAt": time.asctime(time.localtime(package_builder.built_at)),
+            "BuiltFile": package_builder.output,
+            "BuiltName": package_builder.name,
+            "BuiltId": package_builder.id,
+            "BuiltVersion": str(package_builder.version),
+            "BuiltPackages": installed_packages,
+        })
         _brand_file(requirements_file, brand, "## spotfire.spk: ")
     finally:
-        # noinspection PyUnboundLocalVariable
         package_builder.cleanup()
 
 
@@ -986,6 +1165,9 @@ def _promote_brand(brand: _Brand, analyst: bool) -> _Brand:
     return brand
 
 
+_SPK_SUFFIX_RE = re.compile(r"(\.spk)?$")
+
+
 def _handle_versioning(package_builder: _PackageBuilder, installed_packages: _InstalledPackages, brand: _Brand,
                        brand_subkey: str, version: typing.Optional[str], force: bool, versioned_filename: bool) -> None:
     """Properly handle the SPK package version given the packages installed by prior versions of the SPK package
@@ -1000,28 +1182,37 @@ def _handle_versioning(package_builder: _PackageBuilder, installed_packages: _In
     :param force: whether the user has asked to ignore error conditions in versioning
     :param versioned_filename: whether the user has asked to have the generated version added to the SPK package's
                                  filename
+    :raises SpkError: if the version would be downgraded and `force` is not set
     """
     # pylint: disable=too-many-arguments,too-many-positional-arguments
+    built = brand[brand_subkey]
     package_builder.version = _SpkVersion()
-    if "BuiltVersion" in brand[brand_subkey]:
-        package_builder.version = _SpkVersion.from_str(brand[brand_subkey]["BuiltVersion"])
+    if "BuiltVersion" in built:
+        package_builder.version = _SpkVersion.from_str(built["BuiltVersion"])
         package_builder.version.increment_minor()
-        if "BuiltPackages" in brand[brand_subkey]:
+        if "BuiltPackages" in built:
             # Tick the major version if required
-            if _should_increment_major(brand[brand_subkey]["BuiltPackages"], installed_packages, force):
+            if _should_increment_major(built["BuiltPackages"], installed_packages, force):
                 package_builder.version.increment_major()
     # Handle manually specified version numbers
     if version:
         given_version = _SpkVersion.from_str(version)
         if given_version < package_builder.version:
-            _error(f"Package version '{given_version}' is lower than generated version '{package_builder.version}'.")
+            message = f"Package version '{given_version}' is lower than generated version '{package_builder.version}'."
             if not force:
-                sys.exit(1)
+                raise SpkError(message)
+            _error(message)
         package_builder.version = given_version
     # Handle versioned filenames
     if versioned_filename:
-        package_builder.output = re.sub(r"(\.spk)?$", fr"-{str(package_builder.version)}\1",
-                                        package_builder.output, 1)
+        suffix = f"-{package_builder.version}"
+        package_builder.output = _SPK_SUFFIX_RE.sub(lambda match: f"{suffix}{match.group(1) or ''}",
+                                                    package_builder.output, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_version(version: str) -> pkg_version.Version:
+    return pkg_version.parse(version)
 
 
 def _should_increment_major(old_packages: _InstalledPackages, new_packages: _InstalledPackages, force: bool) -> bool:
@@ -1031,20 +1222,23 @@ def _should_increment_major(old_packages: _InstalledPackages, new_packages: _Ins
     :param new_packages: dictionary mapping packages to versions present in the new version of the SPK package
     :param force: whether the user has asked to ignore error conditions in versioning
     :return: whether the major component of the version should be incremented
+    :raises SpkError: if a package would be downgraded and `force` is not set
     """
     tick_major = False
-    # Check for removed packages
-    if old_packages.keys() - new_packages.keys():
-        tick_major = True
-    # Check for package downgrades
-    for pkg in old_packages.keys() & new_packages.keys():
-        previous_version = pkg_version.parse(old_packages[pkg])
-        new_version = pkg_version.parse(new_packages[pkg])
-        if previous_version > new_version:
+    # Brands written by older versions of this module are not keyed by canonical name, so compare canonical names
+    new_canonical = {pkg_utils.canonicalize_name(pkg): version for pkg, version in new_packages.items()}
+    for pkg, previous_version in old_packages.items():
+        new_version = new_canonical.get(pkg_utils.canonicalize_name(pkg))
+        if new_version is None:
+            # Removed package
+            tick_major = True
+        elif new_version != previous_version and _parse_version(previous_version) > _parse_version(new_version):
+            # Downgraded package; unchanged version strings cannot be downgrades, so those are not parsed
             tick_major = True
-            _error(f"Package '{pkg}' has a lower version than previously built.")
+            message = f"Package '{pkg}' has a lower version than previously built."
             if not force:
-                sys.exit(1)
+                raise SpkError(message)
+            _error(message)
     return tick_major
 
 
@@ -1056,7 +1250,11 @@ def main() -> None:
     if cli_args.subcommand is None:
         CLI_PARSER.print_help()
     else:
-        cli_args.func(cli_args)
+        try:
+            cli_args.func(cli_args)
+        except SpkError as exc:
+            print(f"Error: {exc}", file=sys.stderr)
+            sys.exit(1)
 
 
 if __name__ == '__main__':
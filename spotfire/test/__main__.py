@@ -14,7 +14,8 @@ from spotfire.test import utils
 
 TEST_MODULES = ['spotfire.test.test_cabfile',
                 'spotfire.test.test_data_function',
-                'spotfire.test.test_sbdf']
+                'spotfire.test.test_sbdf',
+                'spotfire.test.test_spk']
 
 
 # noinspection PyUnusedLocal
@@ -0,0 +1,363 @@
+"""Tests for the helpers used to build SPK packages."""
+
+import contextlib
+from importlib import metadata as imp_md
+import io
+import os
+import platform
+import tempfile
+import time
+import unittest
+from unittest import mock
+import zipfile
+from xml.etree import ElementTree
+
+from spotfire import spk
+
+
+def _write_files(root: str, files: dict[str, str]) -> None:
+    """Create files (and the directories they are in) under a root directory."""
+    for name, content in files.items():
+        filename = os.path.join(root, *name.split("/"))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as file:
+            file.write(content)
+
+
+class SpkScanTest(unittest.TestCase):
+    """Unit tests for scanning directories for files to place in SPK packages."""
+    # pylint: disable=protected-access
+
+    def test_scan_directory(self):
+        """Verify that scanning finds files and links to files, but does not follow links to directories."""
+        if platform.system() == "Windows":
+            self.skipTest("Creating symbolic links requires extra privileges on Windows")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_files(tmpdir, {"top.txt": "top", "a/mid.txt": "mid", "a/b/deep.txt": "deep"})
+            os.symlink("mid.txt", os.path.join(tmpdir, "a", "file_link"))
+            os.symlink("b", os.path.join(tmpdir, "a", "dir_link"))
+            os.symlink("missing", os.path.join(tmpdir, "broken_link"))
+            found = sorted(os.path.relpath(entry.path, tmpdir) for entry in spk._scan_directory(tmpdir))
+            self.assertEqual(found, sorted(["top.txt", "broken_link", os.path.join("a", "mid.txt"),
+                                            os.path.join("a", "file_link"), os.path.join("a", "b", "deep.txt")]))
+
+    def test_scan_missing_directory(self):
+        """Verify that scanning a directory that does not exist finds nothing."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertEqual(list(spk._scan_directory(os.path.join(tmpdir, "missing"))), [])
+
+
+class SpkVersionTest(unittest.TestCase):
+    """Unit tests for the '_SpkVersion' class in the 'spotfire.spk' module."""
+    # pylint: disable=protected-access
+
+    def test_from_str(self):
+        """Verify parsing version numbers from strings."""
+        self.assertEqual(str(spk._SpkVersion.from_str("1.2.3.4")), "1.2.3.4")
+        self.assertEqual(str(spk._SpkVersion.from_str("5")), "5.0.0.0")
+        with self.assertRaises(ValueError):
+            spk._SpkVersion.from_str("1.2.3.4.5")
+        with self.assertRaises(ValueError):
+            spk._SpkVersion.from_str("1.two.3.4")
+
+    def test_increment(self):
+        """Verify incrementing components of version numbers."""
+        version = spk._SpkVersion(1, 2, 3, 4)
+        self.assertEqual(str(version), "1.2.3.4")
+        version.increment_minor()
+        self.assertEqual(str(version), "1.3.0.0")
+        version.increment_major()
+        self.assertEqual(str(version), "2.0.0.0")
+
+    def test_decrement(self):
+        """Verify decrementing components of version numbers."""
+        version = spk._SpkVersion(2, 3, 4, 5)
+        version.decrement_major()
+        self.assertEqual(str(version), "1.0.0.0")
+        version = spk._SpkVersion(1, 2, 3, 4)
+        version.decrement_minor()
+        self.assertEqual(str(version), "1.1.0.0")
+        version = spk._SpkVersion(1, 2, 3, 4)
+        version.decrement_service_pack()
+        self.assertEqual(str(version), "1.2.2.0")
+
+    def test_decrement_wrap_around(self):
+        """Verify that decrementing a zero component borrows from the larger components."""
+        version = spk._SpkVersion(1, 0, 0, 5)
+        version.decrement_service_pack()
+        self.assertEqual(str(version), "0.99.99.0")
+        version = spk._SpkVersion(1, 0, 0, 5)
+        version.decrement_service_pack(wrap_around=9)
+        self.assertEqual(str(version), "0.9.9.0")
+        version = spk._SpkVersion(1, 2, 0, 0)
+        version.decrement_service_pack()
+        self.assertEqual(str(version), "1.1.99.0")
+        version = spk._SpkVersion(3, 0, 7, 7)
+        version.decrement_minor()
+        self.assertEqual(str(version), "2.99.0.0")
+
+    def test_decrement_underflow(self):
+        """Verify that decrementing below zero raises an error and leaves the version at zero."""
+        version = spk._SpkVersion(0, 5, 5, 5)
+        with self.assertRaises(ValueError):
+            version.decrement_major()
+        self.assertEqual(str(version), "0.0.0.0")
+        version = spk._SpkVersion(0, 0, 0, 7)
+        with self.assertRaises(ValueError):
+            version.decrement_service_pack()
+        self.assertEqual(str(version), "0.0.0.0")
+        version = spk._SpkVersion(0, 0, 3, 7)
+        with self.assertRaises(ValueError):
+            version.decrement_minor()
+        self.assertEqual(str(version), "0.0.0.0")
+
+
+    def test_compare(self):
+        """Verify comparing version numbers."""
+        self.assertEqual(spk._SpkVersion(1, 2, 3, 4), spk._SpkVersion.from_str("1.2.3.4"))
+        self.assertNotEqual(spk._SpkVersion(1, 2, 3, 4), spk._SpkVersion(1, 2, 3, 5))
+        self.assertTrue(spk._SpkVersion(1, 2, 3, 4) < spk._SpkVersion(1, 10, 0, 0))
+        self.assertTrue(spk._SpkVersion(2, 0, 0, 0) > spk._SpkVersion(1, 99, 99, 99))
+        self.assertTrue(spk._SpkVersion(1, 2, 3, 4) <= spk._SpkVersion(1, 2, 3, 4))
+        self.assertTrue(spk._SpkVersion(1, 2, 3, 4) >= spk._SpkVersion(1, 2, 3, 4))
+        self.assertNotEqual(spk._SpkVersion(), "1.0.0.0")
+
+
+class SpkPackageBuilderTest(unittest.TestCase):
+    """Unit tests for the package builders in the 'spotfire.spk' module."""
+    # pylint: disable=protected-access
+
+    def test_remove_package_files(self):
+        """Verify that removing a distribution deletes its files and the directories they leave empty."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_files(tmpdir, {
+                "pkg/__init__.py": "",
+                "pkg/sub/deep/mod.py": "",
+                "shared/mine.py": "",
+                "shared/other.py": "",
+                "pkg-1.0.dist-info/METADATA": "Metadata-Version: 2.1\nName: pkg\nVersion: 1.0\n",
+                "pkg-1.0.dist-info/RECORD": "".join(f"{name},,\n" for name in (
+                    "pkg/__init__.py", "pkg/sub/deep/mod.py", "shared/mine.py", "pkg-1.0.dist-info/METADATA",
+                    "pkg-1.0.dist-info/RECORD")),
+            })
+            dist = imp_md.Distribution.at(os.path.join(tmpdir, "pkg-1.0.dist-info"))
+            with contextlib.redirect_stdout(io.StringIO()):
+                spk._ZipPackageBuilder()._remove_package_files(tmpdir, dist)
+            self.assertEqual(os.listdir(tmpdir), ["shared"])
+            self.assertEqual(os.listdir(os.path.join(tmpdir, "shared")), ["other.py"])
+
+    def test_remove_included_packages(self):
+        """Verify that only distributions on the deny list are removed from a directory of packages."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_files(tmpdir, {
+                "pandas/__init__.py": "",
+                "pandas-2.1.0.dist-info/METADATA": "Metadata-Version: 2.1\nName: pandas\nVersion: 2.1.0\n",
+                "pandas-2.1.0.dist-info/RECORD": "pandas/__init__.py,,\npandas-2.1.0.dist-info/METADATA,,\n"
+                                                 "pandas-2.1.0.dist-info/RECORD,,\n",
+                "yaml/__init__.py": "",
+                "PyYAML-6.0.dist-info/METADATA": "Metadata-Version: 2.1\nName: PyYAML\nVersion: 6.0\n",
+                "PyYAML-6.0.dist-info/RECORD": "yaml/__init__.py,,\nPyYAML-6.0.dist-info/METADATA,,\n"
+                                               "PyYAML-6.0.dist-info/RECORD,,\n",
+                "six.py": "",
+                "six-1.16.0.dist-info/METADATA": "Metadata-Version: 2.1\nName: six\nVersion: 1.16.0\n",
+                "six-1.16.0.dist-info/RECORD": "six.py,,\nsix-1.16.0.dist-info/METADATA,,\n"
+                                              "six-1.16.0.dist-info/RECORD,,\n",
+            })
+            builder = spk._ZipPackageBuilder()
+            with mock.patch.object(builder, "requirements_of", return_value={"spotfire", "pandas", "PyYAML"}), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                versions = builder.remove_included_packages(tmpdir, {"pandas": "2.1.0", "pyyaml": "6.0",
+                                                                     "six": "1.16.0"})
+            self.assertEqual(versions, {"six": "1.16.0"})
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["six-1.16.0.dist-info", "six.py"])
+
+    def test_cleanup(self):
+        """Verify that cleaning up removes temporary directories (including links in them) and files."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tempdir = os.path.join(tmpdir, "temp")
+            _write_files(tempdir, {"top.txt": "", "a/b/deep.txt": "", "c/mid.txt": ""})
+            keep = os.path.join(tmpdir, "keep")
+            _write_files(keep, {"kept.txt": ""})
+            if platform.system() != "Windows":
+                os.symlink(keep, os.path.join(tempdir, "a", "link"))
+            tempfile_name = os.path.join(tmpdir, "temp.pth")
+            _write_files(tmpdir, {"temp.pth": ""})
+            builder = spk._ZipPackageBuilder()
+            builder._cleanup_dirs.append(tempdir)
+            builder._cleanup_files.append(tempfile_name)
+            builder.cleanup()
+            self.assertEqual(os.listdir(tmpdir), ["keep"])
+            self.assertEqual(os.listdir(keep), ["kept.txt"])
+
+    def test_sort_contents(self):
+        """Verify that duplicate payload names are removed (keeping the last one added) and the rest are sorted."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_files(tmpdir, {"first.txt": "", "second.txt": "", "third.txt": ""})
+            first, second, third = (os.path.join(tmpdir, name) for name in ("first.txt", "second.txt", "third.txt"))
+            builder = spk._ZipPackageBuilder()
+            builder.add(first, "root\\b.txt")
+            builder.add(third, "root\\a.txt")
+            builder.add(second, "root\\b.txt")
+            builder._sort_contents()
+            self.assertEqual([mapping[:2] for mapping in builder._contents],
+                             [(third, "root\\a.txt"), (second, "root\\b.txt")])
+
+
+class SpkZipTest(unittest.TestCase):
+    """Unit tests for writing files into zip archives in the 'spotfire.spk' module."""
+    # pylint: disable=protected-access
+
+    def _write_file(self, tmpdir: str, name: str, data: bytes) -> zipfile.ZipInfo:
+        """Write a file into a new zip archive, and verify that its contents and metadata were written."""
+        filename = os.path.join(tmpdir, name)
+        with open(filename, "wb") as file:
+            file.write(data)
+        file_stat = os.lstat(filename)
+        archive_filename = os.path.join(tmpdir, "archive.zip")
+        with zipfile.ZipFile(archive_filename, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            spk._zip_write_file(archive, filename, f"dir/{name}", file_stat)
+        with zipfile.ZipFile(archive_filename) as archive:
+            info = archive.getinfo(f"dir/{name}")
+            self.assertEqual(archive.read(info), data)
+        self.assertEqual(info.external_attr >> 16, file_stat.st_mode & 0xFFFF)
+        self.assertEqual(info.date_time[:5], time.localtime(file_stat.st_mtime)[:5])
+        return info
+
+    def test_write_small_file(self):
+        """Verify writing a file that is read into memory in one call."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            info = self._write_file(tmpdir, "small.txt", b"The quick brown fox jumps over the lazy dog.\n" * 100)
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_write_empty_file(self):
+        """Verify writing a file with no contents."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self._write_file(tmpdir, "empty.txt", b"")
+
+    def test_write_limit_file(self):
+        """Verify writing a file that is exactly as large as the largest file read into memory in one call."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self._write_file(tmpdir, "limit.bin", bytes(range(256)) * (spk._ZIP_READ_LIMIT // 256))
+
+    def test_write_large_file(self):
+        """Verify writing a file that is streamed into the archive."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            info = self._write_file(tmpdir, "large.bin", bytes(range(256)) * (spk._ZIP_READ_LIMIT // 256 + 1))
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+
+    def test_write_compressed_files(self):
+        """Verify that files which are already compressed are stored instead of deflated."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            info = self._write_file(tmpdir, "small.WHL", b"PK\x03\x04" * 100)
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            info = self._write_file(tmpdir, "large.zip", bytes(range(256)) * (spk._ZIP_READ_LIMIT // 256 + 1))
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+class SpkMetadataTest(unittest.TestCase):
+    """Unit tests for the metadata documents written into SPK packages."""
+    # pylint: disable=protected-access
+
+    def test_metadata_file_element(self):
+        """Verify that the serialized file elements match what ElementTree produces."""
+        for path, date in [("root\\python\\lib\\a.py", "2024-01-02T03:04:05Z"),
+                           ("root\\q&\"<x>'.txt", "a\r\nb\tc"),
+                           ("root\\é中.txt", "2024-01-02T03:04:05Z")]:
+            element = ElementTree.Element("File", {"TargetRelativePath": path, "LastModifiedDate": date})
+            expected = ElementTree.tostring(element, encoding="utf-8", short_empty_elements=True)
+            self.assertEqual(spk._metadata_file_element(path, date), expected)
+
+    def test_build_metadata(self):
+        """Verify that the file elements written while building the payload end up in a well-formed document."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_files(tmpdir, {"a.txt": "a", "b/c.txt": "c"})
+            for name in ("a.txt", os.path.join("b", "c.txt")):
+                os.chmod(os.path.join(tmpdir, name), 0o644)
+            builder = spk._ZipPackageBuilder()
+            builder.name = "Test"
+            builder.id = "00000000-0000-0000-0000-000000000000"
+            builder.chmod_script_name = "test-chmod"
+            builder.output = os.path.join(tmpdir, "test.spk")
+            builder.add(os.path.join(tmpdir, "a.txt"), "root/a.txt")
+            builder.add(os.path.join(tmpdir, "b", "c.txt"), "root/b/c.txt")
+            with contextlib.redirect_stdout(io.StringIO()):
+                builder.build()
+            with zipfile.ZipFile(builder.output) as spk_file:
+                metadata = ElementTree.fromstring(spk_file.read("Metadata.xml"))
+                with zipfile.ZipFile(spk_file.open("Contents/Test.zip")) as payload:
+                    payload_names = payload.namelist()
+        self.assertEqual(metadata.tag, "Package")
+        self.assertEqual([child.tag for child in metadata], ["Files", "Assemblies", "ClientModule", "ArchiveFormat"])
+        files = metadata.findall("Files/File")
+        self.assertEqual([file.get("TargetRelativePath") for file in files], ["root\\a.txt", "root\\b\\c.txt"])
+        for file in files:
+            self.assertRegex(file.get("LastModifiedDate", ""), r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$")
+        self.assertIn("root/a.txt", payload_names)
+        self.assertIn("root/b/c.txt", payload_names)
+
+    def test_build_failure_cleanup(self):
+        """Verify that the temporary files used while building are removed when the build fails."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            builder = spk._ZipPackageBuilder()
+            builder.name = "Test"
+            builder.output = os.path.join(tmpdir, "test.spk")
+            temp = os.path.join(tmpdir, "temp")
+            os.mkdir(temp)
+            with mock.patch("tempfile.tempdir", temp), mock.patch.object(builder, "_build_payload",
+                                                                          side_effect=OSError("disk full")), \
+                    contextlib.redirect_stdout(io.StringIO()), self.assertRaises(OSError):
+                builder.build()
+            self.assertEqual(os.listdir(temp), [])
+
+    def test_build_duplicates(self):
+        """Verify that when several files are added with the same payload name, only the last one is built."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_files(tmpdir, {"first.txt": "first", "second.txt": "second"})
+            builder = spk._ZipPackageBuilder()
+            builder.name = "Test"
+            builder.chmod_script_name = "test-chmod"
+            builder.output = os.path.join(tmpdir, "test.spk")
+            builder.add(os.path.join(tmpdir, "first.txt"), "root/a.txt")
+            builder.add(os.path.join(tmpdir, "second.txt"), "root/a.txt")
+            with contextlib.redirect_stdout(io.StringIO()):
+                builder.build()
+            with zipfile.ZipFile(builder.output) as spk_file:
+                metadata = ElementTree.fromstring(spk_file.read("Metadata.xml"))
+                with zipfile.ZipFile(spk_file.open("Contents/Test.zip")) as payload:
+                    self.assertEqual([name for name in payload.namelist() if name.startswith("root/")],
+                                     ["root/a.txt"])
+                    self.assertEqual(payload.read("root/a.txt"), b"second")
+        self.assertEqual([file.get("TargetRelativePath") for file in metadata.findall("Files/File")], ["root\\a.txt"])
+
+
+class SpkVersioningTest(unittest.TestCase):
+    """Unit tests for deciding how to increment the version of rebuilt SPK packages."""
+    # pylint: disable=protected-access
+
+    def test_should_increment_major(self):
+        """Verify that only removed packages require a major version increment."""
+        old = {"numpy": "1.26.0", "pandas": "2.1.0"}
+        self.assertFalse(spk._should_increment_major(old, dict(old), False))
+        self.assertFalse(spk._should_increment_major(old, {"numpy": "1.26.4", "pandas": "2.1.0", "six": "1.16"}, False))
+        self.assertTrue(spk._should_increment_major(old, {"numpy": "1.26.0"}, False))
+        self.assertFalse(spk._should_increment_major({"Foo_Bar": "1.0", "PyYAML": "6.0"},
+                                                     {"foo-bar": "1.0", "pyyaml": "6.0.1"}, False))
+        downgraded = {"numpy": "1.25.0", "pandas": "2.1.0"}
+        with self.assertRaises(spk.SpkError):
+            spk._should_increment_major(old, downgraded, False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(spk._should_increment_major(old, downgraded, True))
+
+
+class SpkMainTest(unittest.TestCase):
+    """Unit tests for the command line entry point of the 'spotfire.spk' module."""
+
+    def test_error_exit_code(self):
+        """Verify that errors building a package are reported and exit with a non-zero status."""
+        errors = io.StringIO()
+        with mock.patch("sys.argv", ["spk", "python", "out.spk", "--version", "-1"]), \
+                contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(errors), \
+                self.assertRaises(SystemExit) as context:
+            spk.main()
+        self.assertEqual(context.exception.code, 1)
+        self.assertEqual(errors.getvalue(), "Error: '--version' cannot be less than 0.\n")